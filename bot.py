@@ -1,7 +1,15 @@
+import asyncio
 import os
+import queue
+import random
 import sqlite3
+import threading
 import time
-from datetime import date
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, time as dtime
+import httpx
 from dotenv import load_dotenv
 
 from telegram import (
@@ -11,6 +19,7 @@ from telegram import (
     LabeledPrice,
 )
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     MessageHandler,
     CommandHandler,
@@ -19,8 +28,9 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
+from telegram.error import BadRequest
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # ================== ENV ==================
 
@@ -37,19 +47,45 @@ if not TELEGRAM_TOKEN or not OPENAI_API_KEY:
 if not PAYMENT_PROVIDER_TOKEN:
     raise RuntimeError("❌ Не задан PAYMENT_PROVIDER_TOKEN")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Один долгоживущий HTTP/2-клиент: соединения с OpenAI переиспользуются
+# между запросами без повторного TLS-рукопожатия.
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=120),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
 
 # ================== CONFIG ==================
 
 DB_PATH = "/app/data/dialogs.db"
+READ_POOL_SIZE = 4
 MAX_HISTORY = 30
 FREE_DAILY_LIMIT = 20
 SUMMARY_TRIGGER = 10
+# Если есть резюме, хватает сообщений с момента его последнего обновления.
+RECENT_HISTORY = 2 * SUMMARY_TRIGGER
+# Ограничение размера истории в символах (~3–4 тыс. токенов для русского текста).
+HISTORY_CHAR_BUDGET = 12_000
 SUBSCRIPTION_DAYS = 30
 
 SUBSCRIPTION_PRICE = 99900  # 999 ₽ в копейках
 CURRENCY = "RUB"
 
+STREAM_EDIT_INTERVAL = 1.0
+TELEGRAM_MAX_LEN = 4096
+CACHE_TTL = 60
+CACHE_TTL_JITTER = 10
+CACHE_SIZE = 50_000
+SUMMARY_CACHE_SIZE = 10_000
+HISTORY_CACHE_SIZE = 10_000
+COMPRESS_MIN_BYTES = 200
+
+OPTIMIZE_INTERVAL = 10 * 60
+CHECKPOINT_INTERVAL = 60 * 60
+ARCHIVE_AFTER = 30 * 24 * 60 * 60
+ARCHIVE_AT = dtime(hour=3)
+
 SHORT_GAP = 3 * 24 * 60 * 60
 LONG_GAP = 14 * 24 * 60 * 60
 
@@ -71,6 +107,17 @@ SUMMARY_PROMPT = (
     "3–5 предложений."
 )
 
+# Неизменяемый префикс запроса: одинаковые байты в начале каждого запроса
+# позволяют OpenAI переиспользовать кэш промпта.
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+SUMMARY_MSG = {"role": "system", "content": SUMMARY_PROMPT}
+SUMMARY_CONTEXT_TEMPLATE = "Резюме предыдущего диалога:\n{summary}"
+
+STREAM_ERROR_TEXT = (
+    "Не получилось подготовить ответ.\n"
+    "Пожалуйста, попробуйте написать ещё раз."
+)
+
 PRICING_TEXT = (
     "Подписка на психологический ИИ-ассистент\n\n"
     "Стоимость: 999 ₽ за 30 дней\n\n"
@@ -84,9 +131,21 @@ PRICING_TEXT = (
 # ================== DB ==================
 
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+
+DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=5000;
+"""
+
 conn = sqlite3.connect(DB_PATH, check_same_thread=False)
 cursor = conn.cursor()
 
+cursor.executescript(DB_PRAGMAS)
+
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS messages (
     user_id INTEGER,
@@ -96,6 +155,17 @@ CREATE TABLE IF NOT EXISTS messages (
 )
 """)
 
+# Сообщения старше ARCHIVE_AFTER переезжают сюда, чтобы горячая таблица
+# оставалась маленькой; контекст сохраняется в summaries.
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS messages_archive (
+    user_id INTEGER,
+    role TEXT,
+    content TEXT,
+    ts INTEGER
+)
+""")
+
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS summaries (
     user_id INTEGER PRIMARY KEY,
@@ -120,104 +190,436 @@ CREATE TABLE IF NOT EXISTS subscriptions (
 )
 """)
 
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id INTEGER PRIMARY KEY,
+    user_msg_count INTEGER DEFAULT 0
+)
+""")
+
+cursor.execute("""
+INSERT OR IGNORE INTO user_state
+SELECT user_id, COUNT(*) FROM messages WHERE role='user' GROUP BY user_id
+""")
+
+# Кто был активен в какой день — для /stats без сканирования messages.
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS active_days (
+    date TEXT,
+    user_id INTEGER,
+    PRIMARY KEY (date, user_id)
+)
+""")
+
+if cursor.execute("SELECT 1 FROM active_days LIMIT 1").fetchone() is None:
+    cursor.execute("""
+    INSERT OR IGNORE INTO active_days
+    SELECT date(ts, 'unixepoch', 'localtime'), user_id FROM messages WHERE role='user'
+    UNION
+    SELECT date(ts, 'unixepoch', 'localtime'), user_id FROM messages_archive WHERE role='user'
+    """)
+
+cursor.executescript("""
+CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, ts DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_user_role_ts ON messages(user_id, role, ts DESC);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_expires ON subscriptions(expires_at);
+CREATE INDEX IF NOT EXISTS idx_archive_user_role_ts ON messages_archive(user_id, role, ts DESC);
+ANALYZE;
+PRAGMA optimize;
+""")
+
 conn.commit()
 
+# Писатель — единственный `conn`; чтения идут через пул read-only соединений,
+# которые в режиме WAL не блокируют запись и друг друга.
+read_pool = queue.Queue()
+for _ in range(READ_POOL_SIZE):
+    rc = sqlite3.connect(DB_PATH, check_same_thread=False)
+    rc.executescript(DB_PRAGMAS + "PRAGMA query_only=1;")
+    read_pool.put(rc)
+
+@contextmanager
+def read_conn():
+    rc = read_pool.get()
+    try:
+        yield rc
+    finally:
+        read_pool.put(rc)
+
+# ================== CACHE ==================
+
+_sub_cache: dict[int, tuple[int, float]] = {}  # user_id -> (expires_at, cached_until)
+_usage_cache: dict[int, tuple[str, int]] = {}  # user_id -> (date, count)
+_summary_cache: dict[int, str | None] = {}  # user_id -> summary
+_history_cache: dict[int, deque] = {}  # user_id -> последние MAX_HISTORY сообщений
+_last_seen_cache: dict[int, int] = {}  # user_id -> ts последнего сообщения пользователя
+
+# Кэши меняются и из потоков пула, и из потока записи: все изменения идут
+# под _cache_lock, а чтение — одним вызовом .get(key, _MISSING).
+_cache_lock = threading.Lock()
+_MISSING = object()
+
+def _cache_put(cache, key, value, maxsize=CACHE_SIZE):
+    # Свежие записи — в конец; при переполнении вытесняем самую старую.
+    with _cache_lock:
+        cache.pop(key, None)
+        cache[key] = value
+        if len(cache) > maxsize:
+            cache.pop(next(iter(cache)), None)
+
+def _cache_pop(cache, key):
+    with _cache_lock:
+        cache.pop(key, None)
+
+def _cache_clear(cache):
+    with _cache_lock:
+        cache.clear()
+
+def _cache_summary(user_id, content):
+    _cache_put(_summary_cache, user_id, content, SUMMARY_CACHE_SIZE)
+
+# ================== SQL ==================
+
+# Один и тот же текст запроса попадает в кэш подготовленных выражений sqlite3.
+
+_SQL_INSERT_MESSAGE = "INSERT INTO messages VALUES (?, ?, ?, ?)"
+
+# Последние N сообщений сразу в хронологическом порядке; rowid различает
+# реплики, записанные в одну и ту же секунду.
+_SQL_SELECT_LAST = """
+SELECT role, content FROM (
+    SELECT role, content, ts, rowid AS id FROM messages
+    WHERE user_id=? ORDER BY ts DESC, id DESC LIMIT ?
+) ORDER BY ts, id
+"""
+
+_SQL_SELECT_LAST_USER_TS = "SELECT ts FROM messages WHERE user_id=? AND role='user' ORDER BY ts DESC LIMIT 1"
+
+_SQL_BUMP_USER_MSG_COUNT = """
+INSERT INTO user_state VALUES (?, 1)
+ON CONFLICT(user_id)
+DO UPDATE SET user_msg_count = user_msg_count + 1
+RETURNING user_msg_count
+"""
+
+_SQL_SELECT_ARCHIVED_USER_TS = "SELECT MAX(ts) FROM messages_archive WHERE user_id=? AND role='user'"
+
+_SQL_SELECT_SUMMARY = "SELECT content FROM summaries WHERE user_id=?"
+
+_SQL_UPSERT_SUMMARY = """
+INSERT INTO summaries VALUES (?, ?, ?)
+ON CONFLICT(user_id)
+DO UPDATE SET content=excluded.content, ts=excluded.ts
+"""
+
+_SQL_BUMP_USAGE = """
+INSERT INTO usage VALUES (?, ?, 1)
+ON CONFLICT(user_id, date)
+DO UPDATE SET count = count + 1 WHERE count < ?
+RETURNING count
+"""
+
+_SQL_SELECT_SUBSCRIPTION = "SELECT expires_at FROM subscriptions WHERE user_id=?"
+
+_SQL_UPSERT_SUBSCRIPTION = """
+INSERT INTO subscriptions (user_id, expires_at)
+VALUES (?, ?)
+ON CONFLICT(user_id)
+DO UPDATE SET expires_at=excluded.expires_at
+"""
+
+# Отметка «пользователь писал в этот день» для DAU/WAU.
+_SQL_MARK_ACTIVE = "INSERT OR IGNORE INTO active_days VALUES (?, ?)"
+
+# Вся админская статистика — одним запросом по счётчикам. В user_state есть
+# строка на каждого, кто хоть раз писал, включая архив.
+_SQL_STATS = """
+SELECT
+    (SELECT COUNT(*) FROM user_state),
+    (SELECT COUNT(*) FROM active_days WHERE date = ?),
+    (SELECT COUNT(DISTINCT user_id) FROM active_days WHERE date >= ?),
+    (SELECT COUNT(*) FROM subscriptions WHERE expires_at > ?)
+"""
+
 # ================== HELPERS ==================
 
-def save_message(user_id, role, content):
-    cursor.execute(
-        "INSERT INTO messages VALUES (?, ?, ?, ?)",
-        (user_id, role, content, int(time.time()))
-    )
-    conn.commit()
+db_lock = threading.Lock()
+_write_count = 0
+_next_optimize = 4  # первый PRAGMA optimize уже выполнен при старте
+# Обновления кэшей, которые можно применить только после COMMIT (или нужно
+# откатить при ROLLBACK). Заполняются внутри транзакции, под db_lock.
+_after_commit = []
+_after_rollback = []
 
-def load_history(user_id, limit):
-    cursor.execute(
-        "SELECT role, content FROM messages WHERE user_id=? ORDER BY ts DESC LIMIT ?",
-        (user_id, limit)
-    )
-    rows = cursor.fetchall()
-    return [{"role": r, "content": c} for r, c in reversed(rows)]
+def on_commit(fn, *args):
+    _after_commit.append((fn, args))
 
-def has_history(user_id):
-    cursor.execute("SELECT 1 FROM messages WHERE user_id=? LIMIT 1", (user_id,))
-    return cursor.fetchone() is not None
+def on_rollback(fn, *args):
+    _after_rollback.append((fn, args))
 
-def last_user_ts(user_id):
-    cursor.execute(
-        "SELECT ts FROM messages WHERE user_id=? AND role='user' ORDER BY ts DESC LIMIT 1",
-        (user_id,)
-    )
-    row = cursor.fetchone()
-    return row[0] if row else None
-
-def count_user_messages(user_id):
+def _run_in_tx(fn, *args):
+    global _write_count, _next_optimize
+    with db_lock:
+        changes = conn.total_changes
+        try:
+            with conn:
+                result = fn(*args)
+        except BaseException:
+            for hook, hook_args in _after_rollback:
+                hook(*hook_args)
+            raise
+        else:
+            for hook, hook_args in _after_commit:
+                hook(*hook_args)
+        finally:
+            _after_commit.clear()
+            _after_rollback.clear()
+        if conn.total_changes == changes:
+            return result
+        # Сразу после старта данные и статистика планировщика меняются
+        # быстрее всего: PRAGMA optimize на 4-й, 16-й, 64-й… записи,
+        # дальше хватает периодической задачи.
+        _write_count += 1
+        if _write_count >= _next_optimize:
+            cursor.execute("PRAGMA optimize")
+            _next_optimize *= 4
+        return result
+
+async def run_db(fn, *args):
+    # SQLite — блокирующий вызов; уводим его с event loop в поток.
+    # Каждый вызов — одна транзакция под общим локом соединения.
+    return await asyncio.to_thread(_run_in_tx, fn, *args)
+
+async def run_read(fn, *args):
+    return await asyncio.to_thread(fn, *args)
+
+def pack_content(content):
+    # Длинные тексты храним сжатыми (BLOB), короткие — как есть (TEXT).
+    data = content.encode("utf-8")
+    if len(data) < COMPRESS_MIN_BYTES:
+        return content
+    packed = zlib.compress(data)
+    return packed if len(packed) < len(data) else content
+
+def unpack_content(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+def save_message(user_id, role, content, ts=None):
     cursor.execute(
-        "SELECT COUNT(*) FROM messages WHERE user_id=? AND role='user'",
-        (user_id,)
+        _SQL_INSERT_MESSAGE,
+        (user_id, role, pack_content(content), ts or int(time.time()))
     )
+    # Историю дополняем сразу: recent_history в той же транзакции должен
+    # видеть новое сообщение. При откате кэш истории пользователя сбрасываем.
+    hist = _history_cache.get(user_id)
+    if hist is not None:
+        hist.append({"role": role, "content": content})
+        on_rollback(_cache_pop, _history_cache, user_id)
+    if role == "user":
+        on_commit(_cache_put, _last_seen_cache, user_id, ts or int(time.time()))
+
+def _message_row(cur, row):
+    return {"role": row[0], "content": unpack_content(row[1])}
+
+def select_history(db, user_id, limit):
+    # Строки сразу собираются в словари для OpenAI, без промежуточных кортежей.
+    cur = db.cursor()
+    cur.row_factory = _message_row
+    return cur.execute(_SQL_SELECT_LAST, (user_id, limit)).fetchall()
+
+def trim_history(history, budget=HISTORY_CHAR_BUDGET):
+    # Отбрасываем самые старые сообщения, пока история не уложится в бюджет;
+    # последнее сообщение остаётся всегда.
+    total = 0
+    for i in range(len(history) - 1, -1, -1):
+        total += len(history[i]["content"])
+        if total > budget and i < len(history) - 1:
+            return history[i + 1:]
+    return history
+
+def recent_history(user_id, limit):
+    # Скользящее окно истории в памяти: база читается только при первом
+    # обращении к пользователю. Вызывается под db_lock (через run_db).
+    hist = _history_cache.get(user_id)
+    if hist is None:
+        hist = deque(select_history(conn, user_id, MAX_HISTORY), maxlen=MAX_HISTORY)
+    _cache_put(_history_cache, user_id, hist, HISTORY_CACHE_SIZE)
+    return trim_history(list(hist)[-limit:])
+
+def get_history_state(user_id):
+    # Время последнего сообщения пользователя; None — истории нет.
+    # Кэшируем только найденных: у новых пользователей история появится
+    # с первым save_message, который сам обновит кэш.
+    cached = _last_seen_cache.get(user_id, _MISSING)
+    if cached is not _MISSING:
+        return cached
+
+    with read_conn() as rc:
+        row = rc.execute(_SQL_SELECT_LAST_USER_TS, (user_id,)).fetchone()
+        if row is None:
+            row = rc.execute(_SQL_SELECT_ARCHIVED_USER_TS, (user_id,)).fetchone()
+    last_ts = row[0] if row else None
+    if last_ts is not None:
+        _cache_put(_last_seen_cache, user_id, last_ts)
+    return last_ts
+
+def bump_user_msg_count(user_id):
+    cursor.execute(_SQL_BUMP_USER_MSG_COUNT, (user_id,))
     return cursor.fetchone()[0]
 
 def get_summary(user_id):
-    cursor.execute("SELECT content FROM summaries WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
-    return row[0] if row else None
+    cached = _summary_cache.get(user_id, _MISSING)
+    if cached is not _MISSING:
+        return cached
+
+    with read_conn() as rc:
+        row = rc.execute(_SQL_SELECT_SUMMARY, (user_id,)).fetchone()
+    content = row[0] if row else None
+    _cache_summary(user_id, content)
+    return content
 
 def save_summary(user_id, content):
-    cursor.execute(
-        """
-        INSERT INTO summaries VALUES (?, ?, ?)
-        ON CONFLICT(user_id)
-        DO UPDATE SET content=excluded.content, ts=excluded.ts
-        """,
-        (user_id, content, int(time.time()))
-    )
-    conn.commit()
+    cursor.execute(_SQL_UPSERT_SUMMARY, (user_id, content, int(time.time())))
+    on_commit(_cache_summary, user_id, content)
 
-def generate_summary(user_id):
-    history = load_history(user_id, MAX_HISTORY)
-    messages = [{"role": "system", "content": SUMMARY_PROMPT}] + history
-    r = client.chat.completions.create(
+async def generate_summary(user_id):
+    history = await run_db(recent_history, user_id, MAX_HISTORY)
+    # Вся история может быть в архиве — без неё резюме не из чего делать.
+    if not history:
+        return
+    messages = [SUMMARY_MSG, *history]
+    r = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
         temperature=0.4
     )
-    save_summary(user_id, r.choices[0].message.content.strip())
+    await run_db(save_summary, user_id, r.choices[0].message.content.strip())
+
+_summary_locks: dict[int, list] = {}  # user_id -> [lock, число держателей и ожидающих]
+_background_tasks: set[asyncio.Task] = set()
+
+@asynccontextmanager
+async def summary_lock(user_id):
+    # Запись живёт, пока лок кто-то держит или ждёт, и удаляется последним.
+    entry = _summary_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _summary_locks.pop(user_id, None)
+
+async def _refresh_summary(user_id):
+    async with summary_lock(user_id):
+        try:
+            await generate_summary(user_id)
+        except Exception:
+            pass
 
-def today():
-    return date.today().isoformat()
+def schedule_summary(user_id):
+    # Резюме обновляется в фоне, чтобы не задерживать ответ пользователю;
+    # на одного пользователя — не больше одной генерации одновременно.
+    if user_id in _summary_locks:
+        return
+    task = asyncio.create_task(_refresh_summary(user_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-def get_usage(user_id):
-    cursor.execute(
-        "SELECT count FROM usage WHERE user_id=? AND date=?",
-        (user_id, today())
-    )
-    row = cursor.fetchone()
-    return row[0] if row else 0
+_today_cache = [0.0, ""]  # [начало следующих суток (epoch), дата ISO]
 
-def inc_usage(user_id):
-    cursor.execute(
-        """
-        INSERT INTO usage VALUES (?, ?, 1)
-        ON CONFLICT(user_id, date)
-        DO UPDATE SET count = count + 1
-        """,
-        (user_id, today())
-    )
-    conn.commit()
+def today():
+    # Строка даты пересчитывается только после локальной полуночи.
+    if time.time() >= _today_cache[0]:
+        d = date.today()
+        _today_cache[:] = [
+            datetime.combine(d + timedelta(days=1), dtime.min).timestamp(),
+            d.isoformat(),
+        ]
+    return _today_cache[1]
+
+def usage_exhausted(user_id, day):
+    cached = _usage_cache.get(user_id)
+    return bool(cached) and cached[0] == day and cached[1] >= FREE_DAILY_LIMIT
+
+def bump_and_get_usage(user_id, day=None):
+    day = day or today()
+    if usage_exhausted(user_id, day):
+        return None
+
+    # Счётчик растёт, только пока лимит не исчерпан; иначе вернётся None.
+    cursor.execute(_SQL_BUMP_USAGE, (user_id, day, FREE_DAILY_LIMIT))
+    row = cursor.fetchone()
+    count = row[0] if row else None
+    on_commit(_cache_put, _usage_cache, user_id, (day, FREE_DAILY_LIMIT if count is None else count))
+    return count
+
+def cached_subscription(user_id, now):
+    # True/False из кэша или None, если нужно идти в базу.
+    cached = _sub_cache.get(user_id)
+    if cached and cached[1] > now:
+        return cached[0] > now
+    return None
+
+def has_active_subscription(user_id, now=None):
+    now = now or time.time()
+    cached = cached_subscription(user_id, now)
+    if cached is not None:
+        return cached
+
+    with read_conn() as rc:
+        row = rc.execute(_SQL_SELECT_SUBSCRIPTION, (user_id,)).fetchone()
+    expires_at = row[0] if row else 0
+    # Разброс TTL, чтобы записи не истекали одновременно.
+    cached_until = now + CACHE_TTL + random.uniform(0, CACHE_TTL_JITTER)
+    _cache_put(_sub_cache, user_id, (expires_at, cached_until))
+    return expires_at > now
 
 def activate_subscription(user_id: int):
     expires_at = int(time.time()) + SUBSCRIPTION_DAYS * 86400
-    cursor.execute(
-        """
-        INSERT INTO subscriptions (user_id, expires_at)
-        VALUES (?, ?)
-        ON CONFLICT(user_id)
-        DO UPDATE SET expires_at=excluded.expires_at
-        """,
-        (user_id, expires_at)
-    )
-    conn.commit()
+    cursor.execute(_SQL_UPSERT_SUBSCRIPTION, (user_id, expires_at))
+    # Кэш обновляем только после COMMIT: иначе параллельное чтение успело бы
+    # закэшировать «подписки нет» из ещё не зафиксированной базы.
+    cached_until = time.time() + CACHE_TTL + random.uniform(0, CACHE_TTL_JITTER)
+    on_commit(_cache_put, _sub_cache, user_id, (expires_at, cached_until))
+
+def record_user_message(user_id, text, subscribed, now_ts, day, history_limit):
+    # Весь учёт хода за одну транзакцию: лимит, сообщение, счётчик и
+    # свежая история для запроса к модели. None — лимит исчерпан.
+    if not subscribed and bump_and_get_usage(user_id, day) is None:
+        return None
+    save_message(user_id, "user", text, now_ts)
+    cursor.execute(_SQL_MARK_ACTIVE, (day, user_id))
+    user_msg_count = bump_user_msg_count(user_id)
+    return user_msg_count, recent_history(user_id, history_limit)
+
+def get_stats():
+    day = today()
+    week_start = (date.fromisoformat(day) - timedelta(days=6)).isoformat()
+    with read_conn() as rc:
+        return rc.execute(_SQL_STATS, (day, week_start, int(time.time()))).fetchone()
+
+def optimize_db():
+    cursor.execute("PRAGMA optimize")
+
+def checkpoint_db():
+    cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def close_db():
+    while not read_pool.empty():
+        read_pool.get_nowait().close()
+    with db_lock:
+        cursor.execute("PRAGMA optimize")
+        conn.close()
+
+def archive_old_messages():
+    cutoff = int(time.time()) - ARCHIVE_AFTER
+    cursor.execute("INSERT INTO messages_archive SELECT * FROM messages WHERE ts < ?", (cutoff,))
+    cursor.execute("DELETE FROM messages WHERE ts < ?", (cutoff,))
+    _cache_clear(_history_cache)
 
 # ================== UI ==================
 
@@ -226,12 +628,28 @@ def subscribe_keyboard():
         [[InlineKeyboardButton("🟢 Оформить подписку", callback_data="subscribe_start")]]
     )
 
+async def finish_reply(update, sent, answer, shown):
+    # Первая часть заменяет заглушку, остальное (сверх лимита Telegram)
+    # досылается отдельными сообщениями.
+    parts = [answer[i:i + TELEGRAM_MAX_LEN] for i in range(0, len(answer), TELEGRAM_MAX_LEN)]
+    if not parts:
+        return
+    if parts[0].strip() != shown.strip():
+        try:
+            await sent.edit_text(parts[0])
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+    for part in parts[1:]:
+        await update.message.reply_text(part)
+
 # ================== HANDLERS ==================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
+    last_ts = _last_seen_cache.get(uid) or await run_read(get_history_state, uid)
 
-    if not has_history(uid):
+    if last_ts is None:
         text = (
             "Здравствуйте.\n\n"
             "Здесь можно писать так, как вам сейчас получается.\n"
@@ -239,7 +657,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "С чего бы вы хотели начать?"
         )
     else:
-        gap = time.time() - (last_user_ts(uid) or time.time())
+        gap = time.time() - last_ts
         if gap > LONG_GAP:
             text = (
                 "Прошло некоторое время.\n\n"
@@ -281,7 +699,7 @@ async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    activate_subscription(user_id)
+    await run_db(activate_subscription, user_id)
 
     await update.message.reply_text(
         "Спасибо за оплату 💚\n\n"
@@ -291,70 +709,150 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
 
 async def summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not has_history(uid):
+    if uid not in _last_seen_cache and await run_read(get_history_state, uid) is None:
         await update.message.reply_text("Пока нет диалога для резюме.")
         return
 
-    if not get_summary(uid):
-        generate_summary(uid)
+    # Если резюме уже генерируется в фоне, дожидаемся его, а не делаем второе.
+    async with summary_lock(uid):
+        summary = await run_read(get_summary, uid)
+        if not summary:
+            await generate_summary(uid)
+            summary = await run_read(get_summary, uid)
 
-    await update.message.reply_text(get_summary(uid))
+    if not summary:
+        await update.message.reply_text("Пока нет диалога для резюме.")
+        return
+
+    await update.message.reply_text(summary)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
 
-    cursor.execute("SELECT COUNT(DISTINCT user_id) FROM messages WHERE role='user'")
-    total = cursor.fetchone()[0]
-
-    cursor.execute(
-        "SELECT COUNT(DISTINCT user_id) FROM messages "
-        "WHERE role='user' AND ts >= strftime('%s','now','start of day')"
-    )
-    today_users = cursor.fetchone()[0]
+    total, today_users, week_users, subscribers = await run_read(get_stats)
 
     await update.message.reply_text(
         f"📊 Статистика\n\n"
         f"👥 Всего пользователей: {total}\n"
-        f"📆 Активных сегодня: {today_users}"
+        f"📆 Активных сегодня: {today_users}\n"
+        f"🗓 Активных за 7 дней: {week_users}\n"
+        f"💳 Активных подписок: {subscribers}"
     )
 
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     text = update.message.text.strip()
 
-    if get_usage(uid) >= FREE_DAILY_LIMIT:
+    now_ts = int(time.time())
+    day = today()
+
+    # Горячие пользователи проходят проверку по кэшу, без похода в поток к базе.
+    subscribed = cached_subscription(uid, now_ts)
+    if subscribed is None:
+        subscribed = await run_read(has_active_subscription, uid, now_ts)
+
+    turn = None
+    if subscribed or not usage_exhausted(uid, day):
+        summary = _summary_cache.get(uid, _MISSING)
+        if summary is _MISSING:
+            summary = await run_read(get_summary, uid)
+        # Ход пользователя — одной транзакцией (один fsync). Ответ модели
+        # пишем отдельно: держать блокировку записи на время запроса
+        # к OpenAI нельзя.
+        turn = await run_db(
+            record_user_message, uid, text, subscribed, now_ts, day,
+            RECENT_HISTORY if summary else MAX_HISTORY
+        )
+
+    if turn is None:
         await update.message.reply_text(
             "На сегодня бесплатный лимит исчерпан.\n"
             "Можно оформить подписку или продолжить завтра."
         )
         return
 
-    save_message(uid, "user", text)
-    inc_usage(uid)
-
-    if count_user_messages(uid) % SUMMARY_TRIGGER == 0:
-        try:
-            generate_summary(uid)
-        except Exception:
-            pass
+    user_msg_count, history = turn
+    if user_msg_count % SUMMARY_TRIGGER == 0:
+        schedule_summary(uid)
 
-    history = load_history(uid, MAX_HISTORY)
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
+    messages = [SYSTEM_MSG]
+    if summary:
+        messages.append(
+            {"role": "system", "content": SUMMARY_CONTEXT_TEMPLATE.format(summary=summary)}
+        )
+    messages += history
 
-    r = client.chat.completions.create(
+    stream = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
-        temperature=0.6
+        temperature=0.6,
+        stream=True
     )
 
-    answer = r.choices[0].message.content
-    save_message(uid, "assistant", answer)
-    await update.message.reply_text(answer)
+    # Показываем ответ по мере генерации, редактируя одно сообщение
+    # не чаще раза в STREAM_EDIT_INTERVAL секунд.
+    loop = asyncio.get_running_loop()
+    sent = await update.message.reply_text("…")
+    answer = shown = ""
+    last_edit = loop.time()
+
+    try:
+        async with stream:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                answer += chunk.choices[0].delta.content or ""
+                preview = answer[:TELEGRAM_MAX_LEN]
+                if (
+                    preview.strip()
+                    and preview.strip() != shown.strip()
+                    and loop.time() - last_edit >= STREAM_EDIT_INTERVAL
+                ):
+                    # Промежуточная правка не критична: полный ответ уйдёт ниже.
+                    try:
+                        await sent.edit_text(preview)
+                        shown = preview
+                    except BadRequest:
+                        pass
+                    last_edit = loop.time()
+    except Exception:
+        # В истории остаётся то, что пользователь успел увидеть.
+        if shown.strip():
+            await run_db(save_message, uid, "assistant", shown)
+        else:
+            await sent.edit_text(STREAM_ERROR_TEXT)
+        raise
+
+    # Ответ сохраняем до отправки: сбой Telegram не должен разрывать историю.
+    await run_db(save_message, uid, "assistant", answer)
+    await finish_reply(update, sent, answer, shown)
+
+# ================== JOBS ==================
+
+async def optimize_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(optimize_db)
+
+async def checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(checkpoint_db)
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(archive_old_messages)
+
+async def on_shutdown(application):
+    await client.close()
+    await asyncio.to_thread(close_db)
 
 # ================== RUN ==================
 
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+app = (
+    ApplicationBuilder()
+    .token(TELEGRAM_TOKEN)
+    .concurrent_updates(True)
+    .rate_limiter(AIORateLimiter(max_retries=3))
+    .post_shutdown(on_shutdown)
+    .build()
+)
 
 app.add_handler(CommandHandler("start", start))
 app.add_handler(CommandHandler("pricing", pricing_command))
@@ -366,6 +864,10 @@ app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
 app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
 
+app.job_queue.run_repeating(optimize_job, interval=OPTIMIZE_INTERVAL)
+app.job_queue.run_repeating(checkpoint_job, interval=CHECKPOINT_INTERVAL)
+app.job_queue.run_daily(archive_job, time=ARCHIVE_AT)
+
 print("🧠 Бот успешно запущен")
 app.run_polling()
 